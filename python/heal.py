@@ -23,11 +23,22 @@ credit is given to the author.  All other rights reserved.
 """
 from ui.whiskerdata.trace import Whisker_Seg
 from ui.whiskerdata import save_whiskers
-from numpy import *
+import numpy as np
+from numpy.polynomial.legendre import leggauss
+from scipy.optimize import fminbound
+from scipy.spatial import cKDTree
 from warnings import warn
+import math
 import os
 import pdb
 
+try:
+  from numba import njit as _njit
+  _have_numba = True
+except ImportError:
+  _njit = lambda **kwargs: lambda f: f  # fall back to plain python
+  _have_numba = False
+
 def load(moviename, whiskersname):
   from ui.whiskerdata import load_whiskers, load_trajectories
   from ui.genetiff import Reader
@@ -44,13 +55,30 @@ def fix_overlaps_in_frame( wv, shape, scale ):
     wv = dict( [ p for p in enumerate(r) ] )
   return wv
 
-def fix(wvd,movie,scale=2, signal_per_pixel = 0, max_dist = 60, max_angle = 20.*pi/180.):
+def _fix_frame( args ):
+  """ Pool worker: frames are independent, so each is fixed in its own process. """
+  fid, wv, shape, scale = args
+  return fid, fix_overlaps_in_frame( wv, shape, scale )
+
+def fix(wvd,movie,scale=2, signal_per_pixel = 0, max_dist = 60, max_angle = 20.*np.pi/180., processes = None):
   shape = movie[0].shape
+  _warmup_trace_overlap()
   nframes = max( wvd.keys() )
-  for fid,wv in wvd.items():
-    print "Frame %5d of %5d"%(fid,nframes)
-    wv = fix_overlaps_in_frame( wv, shape, scale )
-    wvd[fid] = wv
+  if processes == 1:
+    for fid,wv in wvd.items():
+      print "Frame %5d of %5d"%(fid,nframes)
+      wvd[fid] = fix_overlaps_in_frame( wv, shape, scale )
+  else:
+    from multiprocessing import Pool
+    pool = Pool( processes, initializer = _warmup_trace_overlap )
+    try:
+      jobs = [ (fid,wv,shape,scale) for fid,wv in wvd.iteritems() ]
+      for fid,wv in pool.imap_unordered( _fix_frame, jobs ):
+        print "Frame %5d of %5d"%(fid,nframes)
+        wvd[fid] = wv
+    finally:
+      pool.close()
+      pool.join()
 #   for j,l in choose_gaps(movie[fid],r,signal_per_pixel,max_dist,max_angle):
 #     e = reduce( Whisker_Seg.join, j )
 #     r.discard( j[0] )
@@ -58,106 +86,93 @@ def fix(wvd,movie,scale=2, signal_per_pixel = 0, max_dist = 60, max_angle = 20.*
 #     r.add(e)
   return wvd
     
-def compute_join_length( px, py, tlow = 0.0, thigh = 1.0 ):
-  from scipy.integrate import quad
-  xp  = polyder( px, 1 )
-  yp  = polyder( py, 1 )
-  xp2 = polymul( xp, xp )
-  yp2 = polymul( yp, yp )
-  p   = polyadd( xp2, yp2 )
-  integrand = lambda t: sqrt( polyval( p, t ) )  # ds/dt
-  return quad(integrand, tlow, thigh) [0]       
-
-def compute_join_curvature( px, py ):
-  from scipy.integrate import quad
-  xp  = polyder( px, 1 )
-  xpp = polyder( px, 2 )
-  yp  = polyder( py, 1 )
-  ypp = polyder( py, 2 )
-  pn = polyadd( polymul( xp, ypp ), polymul( yp, xpp )) #numerator
-  pd = polyadd( polymul( xp, xp ) , polymul( yp, yp ) ) #denominator
-  integrand = lambda t:  polyval( pn, t )/( polyval( pd, t )**(0.5)) # d Tangent/ds * ds/dt
-  return quad(integrand, 0, 1) [0]
-
-def compute_join_abs_curvature( px, py ):
-  from scipy.integrate import quad
-  xp  = polyder( px, 1 )
-  xpp = polyder( px, 2 )
-  yp  = polyder( py, 1 )
-  ypp = polyder( py, 2 )
-  pn = polyadd( polymul( xp, ypp ), polymul( yp, xpp )) #numerator
-  pd = polyadd( polymul( xp, xp ) , polymul( yp, yp ) ) #denominator
-  integrand = lambda t:  fabs(polyval( pn, t )/( polyval( pd, t )**(0.5)) ) # |d Tangent/ds * ds/dt|
-  return quad(integrand, 0, 1) [0]
-
-def compute_join_curvature_variation( px, py, mean ):
-  from scipy.integrate import quad
-  xp  = polyder( px, 1 )
-  xpp = polyder( px, 2 )
-  yp  = polyder( py, 1 )
-  ypp = polyder( py, 2 )
-  pn = polyadd( polymul( xp, ypp ), polymul( yp, xpp )) #numerator
-  pd = polyadd( polymul( xp, xp ) , polymul( yp, yp ) ) #denominator
-  #xp2 = polymul( xp, xp )
-  #yp2 = polymul( yp, yp )
-  #p   = polyadd( xp2, yp2 )
-  #dsdt      = lambda t: sqrt( polyval( p, t ) )  # ds/dt
-  integrand = lambda t: ( polyval( pn, t )/( polyval( pd, t )**(0.5)) )**2  #(ds/dt*d Tangent/ds)**2
-  return sqrt( quad(integrand, 0, 1) [0] - mean**2)
-
-def compute_join_max_curvature( px, py ):
-  from scipy.optimize.optimize import fminbound
-  xp  = polyder( px, 1 )
-  xpp = polyder( px, 2 )
-  yp  = polyder( py, 1 )
-  ypp = polyder( py, 2 )
-  pn = polyadd( polymul( xp, ypp ), polymul( yp, xpp )) #numerator
-  pd = polyadd( polymul( xp, xp ) , polymul( yp, yp ) ) #denominator
-  kappa = lambda t:  -fabs(polyval( pn, t )/( polyval( pd, t )**(0.5)) ) 
+# Fixed Gauss-Legendre quadrature on [0,1].  The integrands below are smooth
+# functions of low degree polynomials, so an 8 point rule is essentially exact
+# and avoids an adaptive integrator's per-point python callbacks.
+_quad_t, _quad_w = leggauss( 8 )
+_quad_t = 0.5*( _quad_t + 1.0 )
+_quad_w = 0.5*_quad_w
+
+def _curvature_polys( px, py ):
+  """ Numerator and denominator polynomials shared by the curvature family.
+
+  The denominator is also the squared speed, used by compute_join_length. """
+  xp  = np.polyder( px, 1 )
+  xpp = np.polyder( px, 2 )
+  yp  = np.polyder( py, 1 )
+  ypp = np.polyder( py, 2 )
+  pn = np.polyadd( np.polymul( xp, ypp ), np.polymul( yp, xpp )) #numerator
+  pd = np.polyadd( np.polymul( xp, xp ) , np.polymul( yp, yp ) ) #denominator
+  return pn, pd
+
+def compute_join_length( px, py, tlow = 0.0, thigh = 1.0, polys = None ):
+  pn,pd = polys if polys is not None else _curvature_polys( px, py )
+  t = tlow + (thigh-tlow)*_quad_t
+  return (thigh-tlow)*np.dot( _quad_w, np.sqrt( np.polyval( pd, t ) ) ) # integrate ds/dt
+
+def compute_join_curvature( px, py, polys = None ):
+  pn,pd = polys if polys is not None else _curvature_polys( px, py )
+  # integrate d Tangent/ds * ds/dt
+  return np.dot( _quad_w, np.polyval( pn, _quad_t )/( np.polyval( pd, _quad_t )**(0.5)) )
+
+def compute_join_abs_curvature( px, py, polys = None ):
+  pn,pd = polys if polys is not None else _curvature_polys( px, py )
+  # integrate |d Tangent/ds * ds/dt|
+  return np.dot( _quad_w, np.fabs( np.polyval( pn, _quad_t )/( np.polyval( pd, _quad_t )**(0.5)) ) )
+
+def compute_join_curvature_variation( px, py, mean, polys = None ):
+  pn,pd = polys if polys is not None else _curvature_polys( px, py )
+  #integrate (ds/dt*d Tangent/ds)**2
+  ev = np.dot( _quad_w, ( np.polyval( pn, _quad_t )/( np.polyval( pd, _quad_t )**(0.5)) )**2 )
+  return np.sqrt( ev - mean**2)
+
+def compute_join_max_curvature( px, py, polys = None ):
+  pn,pd = polys if polys is not None else _curvature_polys( px, py )
+  kappa = lambda t:  -np.fabs(np.polyval( pn, t )/( np.polyval( pd, t )**(0.5)) ) 
   argmin, res, flag, num = fminbound( kappa, 0, 1, xtol=0.005, full_output=1 )
   return -res[0]
   
 def compute_join_angle( px, py ):
-  from scipy.integrate import quad
-  xp  = polyder( px, 1 )
-  yp  = polyder( py, 1 )
-  integrand = lambda t:  arctan2(polyval(yp, t), polyval(xp, t))  
-  return quad(integrand, 0, 1) [0]
+  xp  = np.polyder( px, 1 )
+  yp  = np.polyder( py, 1 )
+  return np.dot( _quad_w, np.arctan2( np.polyval(yp, _quad_t), np.polyval(xp, _quad_t) ) )
 
 def _compute_intensity( im, x, y ):
-  if ( x<0 ).any()              or  \
-     ( x>=im.shape[1] ).any()   or  \
-     ( y<0 ).any()              or  \
-     ( y>=im.shape[0] ).any():
-     return inf
-  p = set( p for p in zip(x,y) )
-  score = 0
-  for j,i in p:
-    score += im[i,j]
-  return score/len(p)
+  x = x.astype(np.intp)
+  y = y.astype(np.intp)
+  if np.logical_or.reduce( ( x<0, x>=im.shape[1],
+                          y<0, y>=im.shape[0] ) ).any():
+     return np.inf
+  idx = np.unique( y*im.shape[1] + x ) # collapse repeat hits on a pixel
+  return im.ravel()[idx].mean()
 
 def compute_join_intensity( im, px, py ):
-  tt = linspace(0,1,50)
-  x = array( [round(polyval(px,t))  for t in tt] )
-  y = array( [round(polyval(px,t))  for t in tt] )
+  tt = np.linspace(0,1,50)
+  x = np.rint( np.polyval(px,tt) )
+  y = np.rint( np.polyval(py,tt) )
   return _compute_intensity(im,x,y)
 
 def compute_join_score( im, px, py, thick = 2 ):
-  tt = linspace(0,1,50)
-  dpx = polyder(px)
-  dpy = polyder(py)
-  dL2 = polymul(dpx,dpx) + polymul(dpy,dpy)
-  ux  = polyval( px,tt )
-  uy  = polyval( py,tt )
-  dx  = diff(ux) #polyval( px,tt )
-  dy  = diff(uy) #polyval( py,tt )
-  dx  = r_[dx[0],dx]
-  dy  = r_[dy[0],dy]
-  dL  = sqrt( dx**2 + dy**2 )
-
-  a = _compute_intensity(im, ux, uy )  # average score per point along path
-  b = _compute_intensity(im, ux + thick*dy/dL , uy - thick*dx/dL )
-  c = _compute_intensity(im, ux - thick*dy/dL , uy + thick*dx/dL )
+  tt = np.linspace(0,1,50)
+  ux  = np.polyval( px,tt )
+  uy  = np.polyval( py,tt )
+  dx  = np.diff(ux) #np.polyval( px,tt )
+  dy  = np.diff(uy) #np.polyval( py,tt )
+  dx  = np.r_[dx[0],dx]
+  dy  = np.r_[dy[0],dy]
+  dL  = np.sqrt( dx**2 + dy**2 )
+  ox  = thick*dy/dL
+  oy  = thick*dx/dL
+
+  # sample the path and both normal offsets with a single gather over `im`
+  X = np.vstack( (ux, ux + ox, ux - ox) ).astype(np.intp)
+  Y = np.vstack( (uy, uy - oy, uy + oy) ).astype(np.intp)
+  bad = np.logical_or.reduce( ( X<0, X>=im.shape[1],
+                                Y<0, Y>=im.shape[0] ) ).any(axis=1)
+  vals = im[ Y.clip(0,im.shape[0]-1), X.clip(0,im.shape[1]-1) ]
+  scores = vals.mean(axis=1) # average score per point along each path
+  scores[bad] = np.inf       # out of bounds paths score inf, as before
+  a,b,c = scores
 
   # usually have an occlusion on one side (and not trusted)
   # so instead of returning (2*a-b-c)/4.0:
@@ -165,17 +180,17 @@ def compute_join_score( im, px, py, thick = 2 ):
 
 def plot_test(px,py,thick=2):
   from pylab import plot 
-  tt = linspace(0,1,50)
-  dpx = polyder(px)
-  dpy = polyder(py)
-  dL2 = polymul(dpx,dpx) + polymul(dpy,dpy)
-  ux  = polyval( px,tt )
-  uy  = polyval( py,tt )
-  dx  = diff(ux) #polyval( px,tt )
-  dy  = diff(uy) #polyval( py,tt )
-  dx  = r_[dx[0],dx]
-  dy  = r_[dy[0],dy]
-  dL  = sqrt( dx**2 + dy**2 )
+  tt = np.linspace(0,1,50)
+  dpx = np.polyder(px)
+  dpy = np.polyder(py)
+  dL2 = np.polymul(dpx,dpx) + np.polymul(dpy,dpy)
+  ux  = np.polyval( px,tt )
+  uy  = np.polyval( py,tt )
+  dx  = np.diff(ux) #np.polyval( px,tt )
+  dy  = np.diff(uy) #np.polyval( py,tt )
+  dx  = np.r_[dx[0],dx]
+  dy  = np.r_[dy[0],dy]
+  dL  = np.sqrt( dx**2 + dy**2 )
 
   plot( ux, uy , '.-')
   plot( ux + thick*dy/dL , uy - thick*dx/dL ,'-')
@@ -203,20 +218,16 @@ def solve_polynomial_join( left, right, reverse = 0):
      Here a = 0 and b = 1 so m and it's inverse is always the same.
   
   """
-  minv = matrix( [[ 2., -2.,  1.,  1.],
-                  [-3.,  3., -2., -1.],
-                  [ 0.,  0.,  1.,  0.],
-                  [ 1.,  0.,  0.,  0.]])
   #take care of cases joining very short segements
   lr = len(right)
   ll = len(left)
   #L = length( right.x, right.y ) + length( left.x, left.y )
-  #dd = hypot( left.x[0] - right.x[-1], left.y[0] - right.y[-1] )
+  #dd = np.hypot( left.x[0] - right.x[-1], left.y[0] - right.y[-1] )
   nl = ll/4
   nr = lr/4
   slope = lambda v: v[ 0] - v[-1]                   # want the total change over the length
-  #slope = lambda v: diff(v).mean()
-  length = lambda x,y: hypot(diff(x),diff(y)).sum() # euclidian distance in pixels
+  #slope = lambda v: np.diff(v).mean()
+  length = lambda x,y: np.hypot(np.diff(x),np.diff(y)).sum() # euclidian distance in pixels
   #
   # Compute slope at boundary.
   # Uses a number of points near the boundary to compute slope.
@@ -226,10 +237,10 @@ def solve_polynomial_join( left, right, reverse = 0):
   if nr < 2 and nl < 2: 
     lnorm = length(  left.x       ,  left.y        ) 
     rnorm = length( right.x       , right.y        ) 
-    dly =  diff( left.y ).mean() / lnorm
-    dlx =  diff( left.x ).mean() / lnorm
-    dry =  diff(right.y ).mean() / rnorm
-    drx =  diff(right.x ).mean() / rnorm
+    dly =  np.diff( left.y ).mean() / lnorm
+    dlx =  np.diff( left.x ).mean() / lnorm
+    dry =  np.diff(right.y ).mean() / rnorm
+    drx =  np.diff(right.x ).mean() / rnorm
     nl = 0
     nr = lr - 1
   elif nr < 2:                        # use the derivative on the other side
@@ -237,8 +248,8 @@ def solve_polynomial_join( left, right, reverse = 0):
     rnorm = length( right.x       , right.y        ) 
     dly =  -slope( left.y[(-nl):]  ) / lnorm
     dlx =  -slope( left.x[(-nl):]  ) / lnorm
-    dry =  diff(right.y ).mean() / rnorm
-    drx =  diff(right.x ).mean() / rnorm
+    dry =  np.diff(right.y ).mean() / rnorm
+    drx =  np.diff(right.x ).mean() / rnorm
     nr = lr - 1
     #print dly,dlx,dry,drx
   elif nl < 2:                        # use the derivative on the other side
@@ -246,8 +257,8 @@ def solve_polynomial_join( left, right, reverse = 0):
     lnorm = length(  left.x       ,  left.y        ) 
     dry =  -slope(right.y[:nr]  ) / rnorm
     drx =  -slope(right.x[:nr]  ) / rnorm
-    dly =  diff( left.y ).mean() / lnorm
-    dlx =  diff( left.x ).mean() / lnorm
+    dly =  np.diff( left.y ).mean() / lnorm
+    dlx =  np.diff( left.x ).mean() / lnorm
     nl = 0
   else:                               # the "normal" case
     rnorm = length( right.x[:nr], right.y[:nr] )       # Compute path length of right border region
@@ -256,12 +267,12 @@ def solve_polynomial_join( left, right, reverse = 0):
     drx =  -slope(right.x[:nr]  ) / rnorm              # etc...
     dly =  -slope( left.y[(-nl):]  ) / lnorm
     dlx =  -slope( left.x[(-nl):]  ) / lnorm
-  rnorm = hypot( left.x[0] - right.x[0], left.y[0] - right.y[0] ) 
-  lnorm = hypot( left.x[-1]- right.x[0], left.y[-1]- right.y[0] )
-  if not isfinite(dlx): dlx =(left.x[0]  - right.x[0])/lnorm
-  if not isfinite(dly): dly =(left.y[0]  - right.y[0])/lnorm
-  if not isfinite(drx): drx =(left.x[-1] - right.x[0])/rnorm
-  if not isfinite(dry): dry =(left.y[-1] - right.y[0])/rnorm
+  rnorm = np.hypot( left.x[0] - right.x[0], left.y[0] - right.y[0] ) 
+  lnorm = np.hypot( left.x[-1]- right.x[0], left.y[-1]- right.y[0] )
+  if not np.isfinite(dlx): dlx =(left.x[0]  - right.x[0])/lnorm
+  if not np.isfinite(dly): dly =(left.y[0]  - right.y[0])/lnorm
+  if not np.isfinite(drx): drx =(left.x[-1] - right.x[0])/rnorm
+  if not np.isfinite(dry): dry =(left.y[-1] - right.y[0])/rnorm
    
   if reverse:
     dlx = -dlx
@@ -273,22 +284,26 @@ def solve_polynomial_join( left, right, reverse = 0):
   ly = left.y[-1 ]             ## left.y[-nl] 
   rx = right.x[ 0]             ## right.x[nr] 
   lx = left.x[-1 ]             ## left.x[-nl] 
-  L = hypot( rx-lx, ry-ly )    # Approximate dl/dt  
+  L = np.hypot( rx-lx, ry-ly )    # Approximate dl/dt
   #print "L:%g"%L
-  yv = matrix(   [[  ly                          ],   
-                  [  ry                          ],   
-                  [  dly * L                     ],    # dy/dt = dy/dl * dl/dt
-                  [  dry * L                     ]])
-  xv = matrix(   [[  lx                          ],                
-                  [  rx                          ],                
-                  [  dlx * L                     ],  
-                  [  drx * L                     ]])
-  cx = minv*xv
-  cy = minv*yv
-  
-  if not (isfinite(cx).any() and isfinite(cy).any()):
+  dxl = dlx * L                # dx/dt = dx/dl * dl/dt
+  dxr = drx * L
+  dyl = dly * L
+  dyr = dry * L
+  # The basis matrix inverse `minv` (see docstring) is constant, so the four
+  # coefficients unroll to closed form; no 4x4 solve needed per candidate.
+  cx = np.array( [  2.*lx - 2.*rx +    dxl + dxr,
+                -3.*lx + 3.*rx - 2.*dxl - dxr,
+                 dxl,
+                 lx ] )
+  cy = np.array( [  2.*ly - 2.*ry +    dyl + dyr,
+                -3.*ly + 3.*ry - 2.*dyl - dyr,
+                 dyl,
+                 ly ] )
+
+  if not (np.isfinite(cx).any() and np.isfinite(cy).any()):
     pdb.set_trace()
-  return map( lambda t: array(t).squeeze() , (cx,cy) )
+  return cx, cy
 
 def filter_ends( wv, min_score, shape, border = 10 ):
   """
@@ -328,49 +343,100 @@ def group_ends( ends ):
   return [e for e,s in ends if s == 0], [e for e,s in ends if s == -1]
 
 def end_direction(w, side, n=16):
-  a = 0
+  # The mean of diffs over the window telescopes to (last - first)/nsteps,
+  # so the slice/np.diff/mean trio collapses to one subtraction per axis.
   b = min( n, len(w) )
-  if side != 0:
-    a = -b
-    b = -1
-  dx = diff( w.x[a:b] ).mean()
-  dy = diff( w.y[a:b] ).mean()
+  if side == 0:
+    dx = ( w.x[b-1] - w.x[0] )/(b-1)
+    dy = ( w.y[b-1] - w.y[0] )/(b-1)
+  else: # window is w.x[-b:-1], as before
+    dx = ( w.x[-2] - w.x[-b] )/(b-2)
+    dy = ( w.y[-2] - w.y[-b] )/(b-2)
   return dx,dy
 
+@_njit( cache = True )
+def _sample_join( px, py, pth, psc, n ):
+  """ Horner-evaluate the four join polynomials over a shared linspace in one
+  pass, with no intermediate arrays. """
+  x  = np.empty( n, np.float32 )
+  y  = np.empty( n, np.float32 )
+  th = np.empty( n, np.float32 )
+  sc = np.empty( n, np.float32 )
+  den = n-1.0 if n > 1 else 1.0
+  for k in range(n):
+    t = k/den
+    vx = 0.0
+    for c in px: vx = vx*t + c
+    vy = 0.0
+    for c in py: vy = vy*t + c
+    vt = 0.0
+    for c in pth: vt = vt*t + c
+    vs = 0.0
+    for c in psc: vs = vs*t + c
+    x[k]  = vx
+    y[k]  = vy
+    th[k] = vt
+    sc[k] = vs
+  return x,y,th,sc
+
 def make_joining_whisker(px,py,dist,lthick,lscore,rthick,rscore):
   w = Whisker_Seg()
-  tt = linspace(0,1,round(dist))
-  w.x = polyval(px,tt).astype(float32)
-  w.y = polyval(py,tt).astype(float32) 
-  w.thick  = polyval( [rthick-lthick,lthick], tt ).astype(float32) 
-  w.scores = polyval( [rscore-lscore,lscore], tt ).astype(float32)  
+  n = int(round(dist))
+  if _have_numba:
+    w.x, w.y, w.thick, w.scores = _sample_join(
+        np.asarray( px, dtype=np.float64 ),
+        np.asarray( py, dtype=np.float64 ),
+        np.array( [rthick-lthick,lthick], dtype=np.float64 ),
+        np.array( [rscore-lscore,lscore], dtype=np.float64 ), n )
+  else:
+    tt = np.linspace(0,1,n)
+    w.x = np.polyval(px,tt).astype(np.float32)
+    w.y = np.polyval(py,tt).astype(np.float32)
+    w.thick  = np.polyval( [rthick-lthick,lthick], tt ).astype(np.float32)
+    w.scores = np.polyval( [rscore-lscore,lscore], tt ).astype(np.float32)
   return w
 
-def choose_gaps(im,wv, signal_per_pixel = 0.0, max_dist=60, max_angle = pi/4., max_curvature = 10.00):
+def choose_gaps(im,wv, signal_per_pixel = 0.0, max_dist=60, max_angle = np.pi/4., max_curvature = 10.00):
   warn("Nathan doesn't have this working yet.")
 
   left,right = group_ends( list(filter_ends(wv,  0,im.shape)) )  
                       # setting minscore to 0 leaves the thresholding from trace.c intact
                       # more filtering means faster run times but more false negatives.
-  theta  = lambda w,side:     reduce(arctan2, reversed( end_direction(w,side) ) ) # angle at end
-  dtheta = lambda left,right: fabs(theta(left,0) - theta(right,-1))               # magnitude difference in angle between ends
-  candidates = zeros( ( len(left) , len(right) ) )
+  theta  = lambda w,side:     np.arctan2( *reversed( end_direction(w,side) ) )       # angle at end
+  candidates = np.zeros( ( len(left) , len(right) ) )
+  if not ( len(left) and len(right) ):
+    return
+  # Most pairs fail the max_dist test, so query a KD-tree of right endpoints
+  # with a ball around each left endpoint instead of scoring all N*M pairs.
+  lx = np.array( [ a.x[ 0] for a in left  ] )
+  ly = np.array( [ a.y[ 0] for a in left  ] )
+  rx = np.array( [ b.x[-1] for b in right ] )
+  ry = np.array( [ b.y[-1] for b in right ] )
+  tree = cKDTree( np.column_stack( (rx,ry) ) )
+  # end slopes, angles, and slope magnitudes depend on one endpoint only, so
+  # hoist them out of the pair loop (N+M end_direction calls instead of N*M)
+  ldir   = [ np.array( end_direction(a,0) ) for a in left ] # slope at (dx/dl, dy/dl) right side of a
+  ltheta = np.array( [ theta(a, 0) for a in left  ] )
+  rtheta = np.array( [ theta(b,-1) for b in right ] )
+  lnorm  = np.array( [ np.hypot(*v) for v in ldir ] )     # magnitude slope right side of a
   hit = 0
-  for i,a in enumerate(left):
-    for j,b in enumerate(right):
-      dx   = a.x[ 0] - b.x[-1]
-      dy   = a.y[ 0] - b.y[-1]
-      d    = hypot(dx,dy)                 # length of line connecting ends
-      dth  = dtheta(a,b)                  # magnitude change in angle from right end of a to left end of b
-      v    = end_direction(a,0)           # slope at (dx/dl, dy/dl) right side of a
-      norm = hypot(*v)                    # magnitude slope         right side of a
-      proj = dot( v/norm, (dx,dy) )       # projection of vector joining ends onto tangent vector at end of a
+  pairs = ( (i,j) for i,ns in enumerate( tree.query_ball_point( np.column_stack((lx,ly)), max_dist ) )
+                  for j in ns )
+  for i,j in pairs:
+      a = left[i]
+      b = right[j]
+      dx   = lx[i] - rx[j]
+      dy   = ly[i] - ry[j]
+      dth  = np.fabs( ltheta[i] - rtheta[j] ) # magnitude change in angle from right end of a to left end of b
+      v    = ldir[i]
+      norm = lnorm[i]
+      proj = np.dot( v/norm, (dx,dy) )       # projection of vector joining ends onto tangent vector at end of a
       # jth: angle change from a to direct line joining a,b
-      jth = fabs(arctan2( hypot(*( dx-proj*v[0]/norm, dy-proj*v[1]/norm )) , proj )) 
+      jth = np.fabs(np.arctan2( np.hypot(*( dx-proj*v[0]/norm, dy-proj*v[1]/norm )) , proj ))
       #print i,j,
-      #print "\tD: %5.5g Proj: %+5.5g Theta: %5.5g"%(d,proj,jth*180/pi)
+      #print "\tD: %5.5g Proj: %+5.5g Theta: %5.5g"%(np.hypot(dx,dy),proj,jth*180/np.pi)
       l=0;
-      if d < max_dist and jth < max_angle and proj > 0:
+      if jth < max_angle and proj > 0:
         px,py = solve_polynomial_join( b, a )
         l = -compute_join_score(im,px,py)
         #plot_test(px,py)
@@ -393,7 +459,7 @@ def choose_gaps(im,wv, signal_per_pixel = 0.0, max_dist=60, max_angle = pi/4., m
       #print "\tCurvature    : %g"%( c )
       #print "\tLength       : %g"%( compute_join_length   (px,py) )
       #cvar = compute_join_max_curvature(px,py)
-      #print "\tScore: %g Theta: %g"%(l,jth*180/pi)
+      #print "\tScore: %g Theta: %g"%(l,jth*180/np.pi)
       #print "\t* Joining gap:  Score              : %g"%(-l)
       #print "\t                Max Curvature      : %g"%( compute_join_max_curvature(px,py)  )
       #print "\t                Curvature Variation: %g"%( compute_join_curvature_variation(px,py,c)  )
@@ -402,159 +468,177 @@ def choose_gaps(im,wv, signal_per_pixel = 0.0, max_dist=60, max_angle = pi/4., m
     #  yield (b,e,a),l
 
 def gap_measures(im,wv):
-  pmetric = lambda p: sqrt(dot(p[:-1],p[:-1]))
-  left,right = group_ends( list(filter_ends(wv,100,im.shape)) ) 
+  pmetric = lambda p: np.sqrt(np.dot(p[:-1],p[:-1]))
+  left,right = group_ends( list(filter_ends(wv,100,im.shape)) )
   shape = (len(left),len(right) )
-  d = zeros( shape )
-  s = zeros( shape )
-  l = zeros( shape )
-  c = zeros( shape )
-  cx = zeros( shape )
-  cy = zeros( shape )
+  lx = np.array( [ a.x[ 0] for a in left  ] )
+  ly = np.array( [ a.y[ 0] for a in left  ] )
+  rx = np.array( [ b.x[-1] for b in right ] )
+  ry = np.array( [ b.y[-1] for b in right ] )
+  d = np.hypot( lx[:,np.newaxis] - rx[np.newaxis,:], ly[:,np.newaxis] - ry[np.newaxis,:] )
+  s = np.zeros( shape )
+  l = np.zeros( shape )
+  c = np.zeros( shape )
+  cx = np.zeros( shape )
+  cy = np.zeros( shape )
   for i,a in enumerate(left):
     for j,b in enumerate(right):
-      dx = a.x[0 ]-b.x[-1]
-      dy = a.y[0 ]-b.y[-1]
-      d[i,j] = hypot(dx,dy)
       px,py = solve_polynomial_join( b, a )
       lpx,lpy = solve_polynomial_join( a, a, reverse = 1 )
       rpx,rpy = solve_polynomial_join( b, b, reverse = 1 )
       cx[i,j] = max( pmetric( px - lpx ) , pmetric( px - rpx ) )
       cy[i,j] = max( pmetric( px - lpx ) , pmetric( py - rpy ) )
-      l[i,j] = compute_join_length(px,py)
+      polys = _curvature_polys(px,py) # shared by the length/curvature metrics
+      l[i,j] = compute_join_length(px,py, polys=polys)
       s[i,j] = compute_join_score(im,px,py)
-      c[i,j] = compute_join_curvature(px,py)
+      c[i,j] = compute_join_curvature(px,py, polys=polys)
       plot_test(px,py)
-      #if sqrt( px[0]**2 + py[0]**2 ) <  50.0:
+      #if np.sqrt( px[0]**2 + py[0]**2 ) <  50.0:
       #  plot_join(px,py)
   return {'dist':d,'score':s,'path length':l,'curvature x':cx,'curvature y':cy,'total curvature':c}
 
-def trace_overlap( (wa,i), (wb,j), thresh = 2.0 ):
-  # DONE: does not assume that indexes run along same direction
-  def dist(ia,ib):
-    a,b = wa[ia], wb[ib]
-    return hypot( a[0] - b[0], a[1] - b[1] )
+@_njit( cache = True, fastmath = True )
+def _trace_overlap_core( ax, ay, bx, by, i, j, thresh ):
+  """ Scalar dynamic-programming walk over two whisker traces.
+
+  Operates on the raw coordinate arrays so it can be compiled by numba when
+  available.  Returns the overlap bounds as a flat (bnda0,bnda1,bndb0,bndb1)
+  tuple of ints.
+  """
+  na = len(ax)
+  nb = len(bx)
   # determine relative direction of indexing
   ia,ib = i,j
-  if ia == len(wa)-1 or  ib == len(wb)-1:
+  if ia == na-1 or  ib == nb-1:
     if ia != 0 and ib != 0:
-      dax = wa.x[ia-1] - wa.x[ia]
-      day = wa.y[ia-1] - wa.y[ia] 
-      dbx = wb.x[ib-1] - wb.x[ib] 
-      dby = wb.y[ib-1] - wb.y[ib]
+      dax = ax[ia-1] - ax[ia]
+      day = ay[ia-1] - ay[ia]
+      dbx = bx[ib-1] - bx[ib]
+      dby = by[ib-1] - by[ib]
     elif ia == 0:
-      dax = wa.x[ia+1] - wa.x[ia]
-      day = wa.y[ia+1] - wa.y[ia] 
-      dbx = - wb.x[ib-1] + wb.x[ib] 
-      dby = - wb.y[ib-1] + wb.y[ib]
-    elif ib == 0:
-      dax = - wa.x[ia-1] + wa.x[ia]
-      day = - wa.y[ia-1] + wa.y[ia] 
-      dbx = wb.x[ib+1] - wb.x[ib] 
-      dby = wb.y[ib+1] - wb.y[ib]
+      dax = ax[ia+1] - ax[ia]
+      day = ay[ia+1] - ay[ia]
+      dbx = - bx[ib-1] + bx[ib]
+      dby = - by[ib-1] + by[ib]
+    else: # ib == 0
+      dax = - ax[ia-1] + ax[ia]
+      day = - ay[ia-1] + ay[ia]
+      dbx = bx[ib+1] - bx[ib]
+      dby = by[ib+1] - by[ib]
   else:
-    dax = wa.x[ia+1] - wa.x[ia]
-    day = wa.y[ia+1] - wa.y[ia] 
-    dbx = wb.x[ib+1] - wb.x[ib] 
-    dby = wb.y[ib+1] - wb.y[ib]
-  stepa = -1; #only need to keep track of one direction
-  enda  = 0; 
-  notend = lambda i,n: i>n
+    dax = ax[ia+1] - ax[ia]
+    day = ay[ia+1] - ay[ia]
+    dbx = bx[ib+1] - bx[ib]
+    dby = by[ib+1] - by[ib]
+  forward = False #only need to keep track of one direction
   if( abs(dax) > abs(day) ): #determine by x change
     if( dax*dbx < 0 ): #have different signs
-      stepa = 1
-      enda = len(wa)
-      notend = lambda i,n: i<n-1
+      forward = True
   else: #determine by y change
     if( day*dby < 0 ): #have different signs
-      stepa = 1
-      enda = len(wa)
-      notend = lambda i,n: i<n-1
-    
-  bnda = [i,i]
-  bndb = [j,j]
-  ms = 0  
-  while ms < thresh and notend(ia,enda) and ib > 0:
-    moves = ( ( ia + stepa, ib - 1 ),
-              ( ia + stepa, ib     ),
-              ( ia       , ib - 1 ) )
-    scores = [dist( iam, ibm ) for iam, ibm in moves]
-    ms = min(scores)
-    for idx,s in enumerate( scores ): #choose best move
-      if s == ms:
-        ia,ib = moves[idx]
-        break
+      forward = True
+  step = 1 if forward else -1
+
+  ms = 0.0
+  while ms < thresh and ib > 0:
+    if forward:
+      if ia >= na-1: break
+    else:
+      if ia <= 0: break
+    s0 = math.hypot( ax[ia+step] - bx[ib-1], ay[ia+step] - by[ib-1] )
+    s1 = math.hypot( ax[ia+step] - bx[ib  ], ay[ia+step] - by[ib  ] )
+    s2 = math.hypot( ax[ia     ] - bx[ib-1], ay[ia     ] - by[ib-1] )
+    ms = min( s0, s1, s2 )
+    if s0 == ms: #choose best move
+      ia += step; ib -= 1
+    elif s1 == ms:
+      ia += step
+    else:
+      ib -= 1
   #relax at boundary, move downhill
-  if not notend(ia,enda) and ib == 0: 
+  atend = ( ia >= na-1 ) if forward else ( ia <= 0 )
+  if atend and ib == 0:
     pass
-  elif not notend(ia,enda):
+  elif atend:
     last = ms
-    s = dist( ia, ib - 1 )
+    s = math.hypot( ax[ia] - bx[ib-1], ay[ia] - by[ib-1] )
     while s < last and ib > 1:
       ib -= 1
       last = s
-      s = dist( ia, ib - 1 )
+      s = math.hypot( ax[ia] - bx[ib-1], ay[ia] - by[ib-1] )
   elif ib == 0:
     last = ms
-    s = dist( ia + stepa, ib )
-    while s < last and notend(ia,enda-stepa):
-      ia += stepa
+    s = math.hypot( ax[ia+step] - bx[ib], ay[ia+step] - by[ib] )
+    while s < last and ( ( ia < na-2 ) if forward else ( ia > 1 ) ):
+      ia += step
       last = s
-      s = dist( ia + stepa, ib )
+      s = math.hypot( ax[ia+step] - bx[ib], ay[ia+step] - by[ib] )
 
-  bnda[0] = ia
-  bndb[0] = ib
+  bnda0 = ia
+  bndb0 = ib
 
   #flip direction
-  if stepa == -1:
-    stepa = 1
-    enda = len(wa)
-    notend = lambda i,n:i<n-1
-  else:
-    stepa = -1
-    enda = 0
-    notend = lambda i,n: i>n
+  forward = not forward
+  step = -step
 
   ia,ib = i,j
-  ms = 0  
-  while  ms < thresh and notend(ia,enda) and ib < len(wb)-1:
-    moves = ( ( ia + stepa, ib + 1 ),
-              ( ia + stepa, ib     ),
-              ( ia        , ib + 1 ) )
-    scores = [dist( iam, ibm ) for iam, ibm in moves]
-    ms = min(scores)
-    for idx,s in enumerate(scores):
-      if s == ms:
-        ia,ib = moves[idx]
-        break
+  ms = 0.0
+  while ms < thresh and ib < nb-1:
+    if forward:
+      if ia >= na-1: break
+    else:
+      if ia <= 0: break
+    s0 = math.hypot( ax[ia+step] - bx[ib+1], ay[ia+step] - by[ib+1] )
+    s1 = math.hypot( ax[ia+step] - bx[ib  ], ay[ia+step] - by[ib  ] )
+    s2 = math.hypot( ax[ia     ] - bx[ib+1], ay[ia     ] - by[ib+1] )
+    ms = min( s0, s1, s2 )
+    if s0 == ms:
+      ia += step; ib += 1
+    elif s1 == ms:
+      ia += step
+    else:
+      ib += 1
   #relax at boundary, move downhill
-  if not notend(ia,enda) and ib == len(wb)-1: 
+  atend = ( ia >= na-1 ) if forward else ( ia <= 0 )
+  if atend and ib == nb-1:
     pass
-  elif not notend(ia,enda):
+  elif atend:
     last = ms
-    s = dist( ia, ib + 1 )
-    while s < last and ib < len(wb)-2:
+    s = math.hypot( ax[ia] - bx[ib+1], ay[ia] - by[ib+1] )
+    while s < last and ib < nb-2:
       ib += 1
       last = s
-      s = dist( ia, ib + 1 )
-  elif ib == len(wb)-1:
+      s = math.hypot( ax[ia] - bx[ib+1], ay[ia] - by[ib+1] )
+  elif ib == nb-1:
     last = ms
-    s = dist( ia + stepa, ib )
-    while s < last and notend(ia,enda-stepa):
-      ia += stepa
+    s = math.hypot( ax[ia+step] - bx[ib], ay[ia+step] - by[ib] )
+    while s < last and ( ( ia < na-2 ) if forward else ( ia > 1 ) ):
+      ia += step
       last = s
-      s = dist( ia + stepa, ib )
+      s = math.hypot( ax[ia+step] - bx[ib], ay[ia+step] - by[ib] )
 
-  bnda[1] = ia
-  bndb[1] = ib
-  bnda.sort()
-  return bnda, bndb
+  bnda1 = ia
+  bndb1 = ib
+  if bnda0 > bnda1:
+    bnda0,bnda1 = bnda1,bnda0
+  return bnda0, bnda1, bndb0, bndb1
+
+def _warmup_trace_overlap():
+  """ Trigger the (cached) numba compile outside of the per-frame loop. """
+  z = np.zeros( 2, dtype = np.float32 )
+  _trace_overlap_core( z, z, z, z, 0, 0, 2.0 )
+
+def trace_overlap( (wa,i), (wb,j), thresh = 2.0 ):
+  # DONE: does not assume that indexes run along same direction
+  bnda0, bnda1, bndb0, bndb1 = _trace_overlap_core( wa.x, wa.y, wb.x, wb.y,
+                                                    i, j, thresh )
+  return [bnda0,bnda1], [bndb0,bndb1]
 
 def resolution(table, wvd):
   rest = set(wvd.values())
   match = table.next()
   while match:
-    keep,discard = merge(match)
+    keep,discard = merge(match, table._overlap_cache)
     if discard: 
       for a in discard:
         table.remove( a )
@@ -566,24 +650,39 @@ def resolution(table, wvd):
   for a in rest:
     yield a
 
-def pairwise_merge( match, thresh = 0.8 ):
+def pairwise_merge( match, thresh = 0.8, cache = None ):
   """  Will declare the pair as overlapping if the common interval is 
-  greater than `thresh` * length """
-
-  wa = match[0][0]
-  wb = match[1][0]
-  bnda, bndb = trace_overlap(*match)
+  greater than `thresh` * length
+
+  `cache`, when supplied, memoizes the result by whisker pair; the same
+  two whiskers typically collide on many pixels in a frame.  """
+
+  wa,ia = match[0]
+  wb,ib = match[1]
+  key = ( id(wa), id(wb) ) if id(wa) < id(wb) else ( id(wb), id(wa) )
+  if cache is not None and key in cache:
+    keep = cache[key]
+    return ( wa, None ) if keep is wa else ( None, wb ) if keep is wb else ( None, None )
+  # call the jit-able kernel directly; the trace_overlap wrapper only
+  # repackages the bounds as lists
+  bnda0, bnda1, bndb0, bndb1 = _trace_overlap_core( wa.x, wa.y, wb.x, wb.y,
+                                                    ia, ib, 2.0 )
+  bnda = (bnda0, bnda1)
+  bndb = (bndb0, bndb1)
   iscomplete = lambda bnd,w:  (bnd[1] - bnd[0]) >= len(w)*thresh
+  ra,rb = None,None
   if iscomplete(bnda,wa) or iscomplete(bndb,wb):
     sa = wa.scores.sum()
     sb = wb.scores.sum()
     if sa > sb:
-      return wa,None
+      ra,rb = wa,None
     else:
-      return None,wb
-  return None,None
+      ra,rb = None,wb
+  if cache is not None:
+    cache[key] = ra if ra is not None else rb
+  return ra,rb
 
-def merge( match ):
+def merge( match, cache = None ):
   dep = dict( [ (e[0],0) for e in match ] )
 
   #iterate through all pairs and mark those who are contained in another whisker
@@ -591,7 +690,7 @@ def merge( match ):
   match = list(match)
   for i,ma in enumerate(match):
     for j,mb in enumerate(match[ (i+1): ]):
-      ra,rb = pairwise_merge( (ma,mb) )
+      ra,rb = pairwise_merge( (ma,mb), cache = cache )
       if ra or rb:
         if not ra:
           dep[ma[0]] = 1
@@ -609,15 +708,20 @@ class CollisionTable(object):
     self._map = {}
     self._shape  = shape
     self._scale  = scale
-    self._stride = stride = shape[1]/scale
+    # +1 on both axes: points on the far edges (x == shape[1]-1 for odd
+    # widths, etc.) bin to column/row shape/scale, one past the last full bin
+    self._stride = stride = shape[1]/scale + 1
+    npx = stride * ( shape[0]/scale + 1 )
+    self._overlap_cache = {} # pairwise_merge results, keyed by whisker id pair
+    self._px_cache = {}      # whisker -> pixel list, so remove() needn't rehash
+    self._nhits   = np.zeros( npx, dtype=np.uint16 ) # per-pixel hit counts; collisions are found by scanning this flat np.array
+    self._visited = np.zeros( npx, dtype=bool )   # pixels already handed out by next()
     self.topx   = lambda p: int(p[0]/scale) + stride * int(p[1]/scale)
     self._build_inverse_table( wvd )
   
   def _build_inverse_table(self,  wvd ):
-    g = enumerate(wvd)
-    if isinstance(wvd, dict):
-      g = wvd.iteritems()
-    for i,w in g:
+    # any iterable of whiskers works; the dict keys were never used
+    for w in ( wvd.itervalues() if isinstance(wvd, dict) else wvd ):
       self.add(w)
 
   def update( self, changes ):
@@ -632,23 +736,44 @@ class CollisionTable(object):
     if last:
       self.add(last) # add back last middle 
 
+  def _hash(self, w):
+    """ Vectorized topx: the linear (binned) pixel index of every sample point. """
+    xs = ( w.x/self._scale ).astype(np.int32)
+    ys = ( w.y/self._scale ).astype(np.int32)
+    return ( xs + self._stride*ys ).tolist()
+
   def add(self, w):
     if not w: return
-    hash = lambda e: enumerate( map(self.topx,zip(e.x,e.y)) )
-    for i,px in hash(w):
+    pxs = self._px_cache.get(w)
+    if pxs is None:
+      pxs = self._px_cache.setdefault( w, self._hash(w) )
+    seen = set()
+    for i,px in enumerate(pxs):
+      if px in seen: # only the first hit on a pixel counts
+        continue
+      seen.add(px)
       self._map.setdefault(px,set()).add( (w,i) )
-    for i,px in hash(w): # scan back through and remove repeat hits on a pixel
-      for x in [e for e in self._map[px] if e[0] == w][1:]:
-        self._map[px].remove(x)
+    for px in seen: # one count per whisker per pixel
+      self._nhits[px] += 1
+      if self._nhits[px] > 1:
+        self._visited[px] = False # new collision: make next() look here again
 
   def remove(self, w):
     if not w: return
-    hash = lambda e: enumerate( map(self.topx,zip(e.x,e.y)) )
-    for i,px in hash(w):
+    wid = id(w) # drop cached merge results involving this whisker
+    for k in [ k for k in self._overlap_cache if wid in k ]:
+      del self._overlap_cache[k]
+    pxs = self._px_cache.pop( w, None )
+    if pxs is None:
+      pxs = self._hash(w)
+    for i,px in enumerate(pxs):
       s = self._map.get(px)
       if s:
         s.discard( (w,i) )
-    
+    for px in set(pxs):
+      if self._nhits[px] > 0:
+        self._nhits[px] -= 1
+
   def __iter__(self):
     m = self.next()
     while m:
@@ -656,30 +781,25 @@ class CollisionTable(object):
       m = self.next()
 
   def next(self):
-    """ This changes the inverse table by removing hits.
-
-    Returns a (Whisker_Seg, index),(Whisker_Seg, index)...  tuple
+    """ Returns a (Whisker_Seg, index),(Whisker_Seg, index)...  tuple
             or None, if done.
+
+    Collision candidates come from a single vectorized scan of the flat
+    hit-count array rather than a walk over the table's dict entries.
+    Visited pixels are flagged so they aren't handed out twice.
     """
-    todelete = []
-    retval = None
-    for px,s in self._map.iteritems():
-      todelete.append(px) # get rid of references to visited pixels
-      if len(s) > 1:
-        retval = s
-        break
-
-    for k in todelete:
-      del self._map[k]
-
-    return retval
-  
+    for px in np.flatnonzero( (self._nhits > 1) & ~self._visited ):
+      self._visited[px] = True
+      s = self._map.get( int(px) )
+      if s and len(s) > 1:
+        return set(s) # detached copy: callers remove() whiskers while holding it
+    return None
+
   def counts( self ):
     tosc = lambda e: e/self._scale
-    im = zeros(map(tosc, self._shape))
-    imr = im.ravel()
-    for px,s in self._map.iteritems():
-      imr[px] = len(s) #len(set( [e for e,i in s] ))
+    im = np.zeros(map(tosc, self._shape))
+    grid = self._nhits.reshape( -1, self._stride ) # rows are y bins
+    im[:] = grid[ :im.shape[0], :im.shape[1] ]
     return im
 
 if 1:
@@ -746,7 +866,7 @@ if 1:
                     default = "heal") 
     options, args = parser.parse_args()
     
-    options.max_angle *= pi/180.0 # convert from degrees to radians
+    options.max_angle *= np.pi/180.0 # convert from degrees to radians
 
     # try to be friendly about args
     assert( os.path.isfile(args[0]) ) # "Could not find %s"%args[0] )
@@ -35,17 +35,24 @@ int Get_Stack_Dimensions_px( char *filename,
                              int *height, 
                              int *depth, 
                              int *kind)
+// Returns 1 on success, 0 for a file that exists but can't be read as a
+// tiff, and -1 for a missing/unopenable file.
 { int endian,d=0; 
   Tiff_Reader *tif = 0;
   Tiff_IFD *ifd;
   Tiff_Image *tim;
 
   tif = Open_Tiff_Reader( filename, &endian, is_lsm(filename) );
+  if( !tif )
+  { FILE *probe = fopen( filename, "rb" ); // failure-path only: classify it
+    if( !probe )
+      return -1;
+    fclose( probe );
+    return 0;
+  }
   while( !Advance_Tiff_Reader(tif) )
     d += 1;
-  Free_Tiff_Reader( tif );
-
-  tif = Open_Tiff_Reader( filename, &endian, is_lsm(filename) );
+  Rewind_Tiff_Reader( tif );   // one open serves both the count and the first IFD
   ifd = Read_Tiff_IFD( tif );
   tim = Extract_Image_From_IFD( ifd );
 
@@ -78,6 +85,13 @@ int Compute_Sizeof_Stack_Bytes( char *filename )
   return width*height*depth*kind;
 }
 
+// NB: a parallel per-strip decode can't be added here yet.  The underlying
+//   reader keeps global free lists (tiff_io.c: Free_Treader_List et al.) and
+//   static decode scratch (IFD_Vector, LSM_Decode_Block), so no two threads
+//   may be inside the library at once.  Parallelism across *files* is
+//   available from python via ui.reader.tiff.readstacks, which uses one
+//   process per read for the same reason.
+
 void print_usage(void)
 {
   printf("Tiff Images: %5d\n",Tiff_Image_Usage());
@@ -86,6 +100,31 @@ void print_usage(void)
 }
 
 
+SHARED_EXPORT
+int Read_Tiff_Stack_Into_Plane_Buffers( char *filename, void **planes, int nplanes )
+// Like Read_Tiff_Stack_Into_Buffer, but each plane is copied to its own
+// caller-supplied buffer, so no contiguous depth*height*width allocation is
+// required.  Returns the number of planes read.
+{ int endian, z=0;
+  Tiff_Reader *tif = 0;
+  Tiff_IFD *ifd;
+  Tiff_Image *tim;
+  int nbytes;
+
+  tif = Open_Tiff_Reader( filename, &endian, is_lsm(filename) );
+  while( z < nplanes && !End_Of_Tiff( tif ) )
+  { ifd = Read_Tiff_IFD( tif );
+    tim = Extract_Image_From_IFD( ifd );
+    nbytes = (tim->width)*(tim->height)*(tim->channels[0]->bytes_per_pixel);
+    memcpy( planes[z], tim->channels[0]->plane, nbytes );
+    Free_Tiff_Image( tim );
+    Free_Tiff_IFD( ifd );
+    z += 1;
+  }
+  if(tif) Free_Tiff_Reader( tif );
+  return z;
+}
+
 SHARED_EXPORT
 int Read_Tiff_Stack_Into_Buffer( char *filename, void *buffer )
 { int endian; 
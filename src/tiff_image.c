@@ -1422,20 +1422,19 @@ Tiff_Image *Extract_Image_From_IFD(Tiff_IFD *ifd)
     int            i, s;
 
     for (s = 0; s < samples_per_pixel; s++)
-      { unsigned char *w = (unsigned char *) (channel[s]->plane);
-        unsigned char  x;
-
-        if (Bytes_Per_Sample[s] == 2)
+      { if (Bytes_Per_Sample[s] == 2)
 
           { if ((bits_per_sample[s] == 16 && Tiff_IFD_Data_Flip(ifd)) ||
                 (bits_per_sample[s] < 16 && ! Native_Endian()))
 
-              for (i = 0; i < a; i++)
-                { x = w[0];
-                  w[0] = w[1];
-                  w[1] = x;
-                  w += 2;
-                }
+              { unsigned short *w = (unsigned short *) (channel[s]->plane);
+                unsigned short  x;        //  word-wide shift form: compilers
+                                          //    turn this into bswap/vector
+                for (i = 0; i < a; i++)   //    shuffles, unlike the old
+                  { x = w[i];             //    byte-pointer exchange
+                    w[i] = ((unsigned short) (x << 8)) | (x >> 8);
+                  }
+              }
           }
 
         else if (Bytes_Per_Sample[s] == 4)
@@ -1443,15 +1442,15 @@ Tiff_Image *Extract_Image_From_IFD(Tiff_IFD *ifd)
           { if ((bits_per_sample[s] == 32 && Tiff_IFD_Data_Flip(ifd)) ||
                 (bits_per_sample[s] < 32 && ! Native_Endian()))
 
-              for (i = 0; i < a; i++)
-                { x = w[0];
-                  w[0] = w[3];
-                  w[3] = x;
-                  x = w[1];
-                  w[1] = w[2];
-                  w[2] = x;
-		  w += 4;
-		}
+              { unsigned int *w = (unsigned int *) (channel[s]->plane);
+                unsigned int  x;
+
+                for (i = 0; i < a; i++)
+                  { x = w[i];
+                    w[i] = (x >> 24) | ((x >> 8) & 0xff00u)
+                         | ((x << 8) & 0xff0000u) | (x << 24);
+                  }
+              }
 	  }
       }
   }
@@ -1473,14 +1472,24 @@ Tiff_Image *Extract_Image_From_IFD(Tiff_IFD *ifd)
             mask = cmpbits[bits_per_sample[s]];
             sign = ~mask;
 
-            for (y = 0; y < height; y++)
-              { last  = *base;
-                base += 1;
-                for (x = 1; x < width; x++)
-                  { last = ((last + (signed char) (*base | sign)) & mask);
-                    *base++ = last;
-                  }
-              }
+            if (sign == 0)            //  full-width samples (the common case):
+              for (y = 0; y < height; y++)    //  the or/and per sample vanish
+                { last  = *base;              //  and the row is a running sum
+                  base += 1;
+                  for (x = 1; x < width; x++)
+                    { last += *base;
+                      *base++ = last;
+                    }
+                }
+            else
+              for (y = 0; y < height; y++)
+                { last  = *base;
+                  base += 1;
+                  for (x = 1; x < width; x++)
+                    { last = ((last + (signed char) (*base | sign)) & mask);
+                      *base++ = last;
+                    }
+                }
           }
 
         else if (Bytes_Per_Sample[s] == 2)
@@ -1491,14 +1500,24 @@ Tiff_Image *Extract_Image_From_IFD(Tiff_IFD *ifd)
             mask = (cmpbits[bits_per_sample[s]-8] << 8) | 0xff;
             sign = ~mask;
 
-            for (y = 0; y < height; y++)
-              { last  = *base;
-                base += 1;
-                for (x = 1; x < width; x++)
-                  { last = ((last + (signed short) (*base | sign)) & mask);
-                    *base++ = last;
-                  }
-              }
+            if (sign == 0)
+              for (y = 0; y < height; y++)
+                { last  = *base;
+                  base += 1;
+                  for (x = 1; x < width; x++)
+                    { last += *base;
+                      *base++ = last;
+                    }
+                }
+            else
+              for (y = 0; y < height; y++)
+                { last  = *base;
+                  base += 1;
+                  for (x = 1; x < width; x++)
+                    { last = ((last + (signed short) (*base | sign)) & mask);
+                      *base++ = last;
+                    }
+                }
           }
 
         else //  Bytes_Per_Sample[s] == 4
@@ -1512,14 +1531,24 @@ Tiff_Image *Extract_Image_From_IFD(Tiff_IFD *ifd)
               mask = (cmpbits[bits_per_sample[s]-16] << 16) | 0xffff;
             sign = ~mask;
 
-            for (y = 0; y < height; y++)
-              { last  = *base;
-                base += 1;
-                for (x = 1; x < width; x++)
-                  { last = ((last + (signed int) (*base | sign)) & mask);
-                    *base++ = last;
-                  }
-              }
+            if (sign == 0)
+              for (y = 0; y < height; y++)
+                { last  = *base;
+                  base += 1;
+                  for (x = 1; x < width; x++)
+                    { last += *base;
+                      *base++ = last;
+                    }
+                }
+            else
+              for (y = 0; y < height; y++)
+                { last  = *base;
+                  base += 1;
+                  for (x = 1; x < width; x++)
+                    { last = ((last + (signed int) (*base | sign)) & mask);
+                      *base++ = last;
+                    }
+                }
           }
     }
 
@@ -824,6 +824,11 @@ Tiff_Reader *Open_Tiff_Reader(char *name, int *big_endian, int lsm)
       return (NULL);
     }
 
+  setvbuf(input,NULL,_IOFBF,0x100000);  //  1MB stdio buffer: the header/IFD walk
+                                        //    issues many 2- and 4-byte freads, and
+                                        //    a large buffer batches them into few
+                                        //    actual read syscalls
+
   if (fread(&order,2,1,input) != 1)
     goto invalid;
   if (order == 0x4949)
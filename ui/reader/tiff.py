@@ -10,25 +10,53 @@ license terms (http://license.janelia.org/license/jfrc_copyright_1_1.html).
 from ctypes import *
 from ctypes.util import find_library
 import numpy
-from numpy import zeros
-from reader import StackReader
+from reader import StackReader, IMovieReader
 import os,sys
+import mmap
+import struct
+from collections import OrderedDict
 
 dllpath = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
 if sys.platform == 'win32':
-  lib = os.path.join(dllpath,'whisk.dll')
+  _libname = 'whisk.dll'
 else:
-  lib = os.path.join(dllpath,'libwhisk.so')
-#import pdb; pdb.set_trace()
-os.environ['PATH']+=os.pathsep + os.pathsep.join(['.','..',dllpath])
-name = find_library('whisk')
-if not name:
-  name=lib
-cReader = CDLL(name)
+  _libname = 'libwhisk.so'
+
+def _load_whisk():
+  """ We know where the library lives, so probe the candidates directly --
+  no find_library walk over ldconfig/PATH, and os.environ stays untouched
+  (the old PATH append taxed every later subprocess spawn). """
+  err = None
+  for candidate in ( os.path.join( dllpath, _libname ),
+                     os.path.join( '.',  _libname ),
+                     os.path.join( '..', _libname ),
+                     _libname ):
+    try:
+      return candidate, CDLL(candidate)
+    except OSError, e:
+      err = e
+  raise err
+
+name, cReader = _load_whisk()
+
+try:
+  # cffi's ABI mode skips ctypes' per-call libffi marshalling; use it for the
+  # two hot entry points when it's importable, otherwise fall back to ctypes.
+  from cffi import FFI
+  _ffi = FFI()
+  _ffi.cdef("""
+    int Get_Stack_Dimensions_px( const char *filename,
+                                 int *width, int *height, int *depth, int *kind );
+    int Read_Tiff_Stack_Into_Buffer( const char *filename, uint8_t *buffer );
+  """)
+  _creader_ffi = _ffi.dlopen(name)
+  _have_cffi = True
+except ImportError:
+  _have_cffi = False
 
 cReader.Get_Stack_Dimensions_px.restype = c_int
 cReader.Get_Stack_Dimensions_px.argtypes = [
-  POINTER( c_char ), # filename
+  c_char_p,          # filename
   POINTER( c_int ),  # width
   POINTER( c_int ),  # height
   POINTER( c_int ),  # depth
@@ -36,30 +64,413 @@ cReader.Get_Stack_Dimensions_px.argtypes = [
 
 cReader.Read_Tiff_Stack_Into_Buffer.restype = c_int
 cReader.Read_Tiff_Stack_Into_Buffer.argtypes = [
-  POINTER( c_char ),   # filename
+  c_char_p,            # filename
   POINTER( c_uint8 ) ] # buffer
 
-_bpp = {  1   :   numpy.uint8,
-          2   :   numpy.uint16,
-          4   :   numpy.float32,
-          8   :   numpy.float64 }
+try:
+  # kernel readahead hint; py2 has no os.posix_fadvise so go through libc
+  _fadvise = CDLL( find_library('c') ).posix_fadvise
+  _fadvise.restype = c_int
+  _fadvise.argtypes = [ c_int, c_int64, c_int64, c_int ]
+except (AttributeError, OSError, TypeError, ValueError):
+  _fadvise = None # not linux; the read just relies on default readahead
+
+def _prefetch( fn ):
+  """
+  Best-effort hint that `fn` is about to be read start to finish.  Lets the
+  kernel use aggressive readahead and start populating the page cache before
+  the C reader issues its first strip read.
+  """
+  if _fadvise is None:
+    return
+  try:
+    fd = os.open( fn, os.O_RDONLY )
+  except OSError:
+    return # let the reader report the error
+  try:
+    _fadvise( fd, 0, 0, 2 ) # POSIX_FADV_SEQUENTIAL
+    _fadvise( fd, 0, 0, 3 ) # POSIX_FADV_WILLNEED
+  finally:
+    os.close( fd )
+
+def _b( filename ):
+  """ The C side wants bytes; encode unicode filenames once, up front. """
+  if isinstance(filename, unicode):
+    return filename.encode( sys.getfilesystemencoding() or 'utf-8' )
+  return filename
+
+# bind once: avoids CDLL __getattr__ dispatch on every readstack call
+_c_get_dims = cReader.Get_Stack_Dimensions_px
+_c_read_buf = cReader.Read_Tiff_Stack_Into_Buffer
+
+try:
+  _c_read_planes = cReader.Read_Tiff_Stack_Into_Plane_Buffers
+  _c_read_planes.restype = c_int
+  _c_read_planes.argtypes = [
+    c_char_p,            # filename
+    POINTER( c_void_p ), # plane buffers
+    c_int ]              # number of planes
+except AttributeError: # older libwhisk without the planewise entry point
+  _c_read_planes = None
+
+# indexed by bytes-per-pixel; dtypes built once so the per-call lookup is a
+# plain tuple index instead of a dict probe plus lazy dtype construction
+_BPP = ( None,
+         numpy.dtype( numpy.uint8   ),
+         numpy.dtype( numpy.uint16  ),
+         None,
+         numpy.dtype( numpy.float32 ),
+         None, None, None,
+         numpy.dtype( numpy.float64 ) )
+
+def _dtype_of( kind ):
+  """ dtype for a bytes-per-pixel `kind`; IOError on unsupported sizes. """
+  dtype = _BPP[kind] if 0 <= kind < len(_BPP) else None
+  if dtype is None:
+    raise IOError, "Unsupported pixel size (%s bytes per pixel)"%kind
+  return dtype
+
+def _dims_error( ret, filename ):
+  if ret == -1:
+    raise IOError, "File not found. (%s)"%filename
+  raise IOError, "Couldn't read dimensions for %s"%filename
+
+if _have_cffi:
+  def _get_dims( filename ):
+    """ Returns (width, height, depth, kind); raises IOError on failure. """
+    dims = _ffi.new( "int[4]" )
+    ret = _creader_ffi.Get_Stack_Dimensions_px( filename,
+                                                dims+0, dims+1, dims+2, dims+3 )
+    if ret != 1:
+      _dims_error( ret, filename )
+    return tuple(dims)
+  def _read_into( filename, stack ):
+    return _creader_ffi.Read_Tiff_Stack_Into_Buffer( filename,
+              _ffi.cast( "uint8_t*", stack.ctypes.data ) )
+else:
+  def _get_dims( filename ):
+    """ Returns (width, height, depth, kind); raises IOError on failure. """
+    width, height, depth, kind = c_int(0),c_int(0),c_int(0),c_int(0)
+    ret = _c_get_dims( filename,
+                       byref(width),
+                       byref(height),
+                       byref(depth),
+                       byref(kind) )
+    if ret != 1:
+      _dims_error( ret, filename )
+    return width.value, height.value, depth.value, kind.value
+  def _read_into( filename, stack ):
+    return _c_read_buf( filename,
+              stack.ctypes.data_as( POINTER(c_uint8) ))
+
+try:
+  _madvise = CDLL( find_library('c') ).madvise
+  _madvise.restype = c_int
+  _madvise.argtypes = [ c_void_p, c_size_t, c_int ]
+except (AttributeError, OSError, TypeError, ValueError):
+  _madvise = None
+
+_MADV_HUGEPAGE  = 14      # linux; elsewhere madvise just returns EINVAL
+_HUGE_THRESHOLD = 1 << 28 # 256 MB -- below this 4K pages are fine
+
+def _empty_stack( shape, dtype ):
+  """
+  numpy.empty for stack-sized buffers.  Volumes past _HUGE_THRESHOLD come
+  from an anonymous mmap flagged MADV_HUGEPAGE instead, so the kernel can
+  back the sequential first-touch writes with 2 MB pages -- far fewer
+  page faults and TLB misses while the reader fills multi-GB stacks.
+  """
+  dtype  = numpy.dtype( dtype )
+  nbytes = int( numpy.prod( shape ) ) * dtype.itemsize
+  if _madvise is None or nbytes < _HUGE_THRESHOLD:
+    return numpy.empty( shape, dtype )
+  mm = mmap.mmap( -1, nbytes ) # page aligned; released with the array
+  stack = numpy.frombuffer( mm, dtype ).reshape( shape )
+  _madvise( stack.ctypes.data, nbytes, _MADV_HUGEPAGE ) # best effort
+  return stack
+
+def _read_uncompressed( fn, stack ):
+  """
+  Fast path for the common uncompressed stack (e.g. single-strip uint16
+  microscopy data): copy pixels straight out of an mmap of the file,
+  bypassing the C decoder's IFD/image machinery.  Returns True when it
+  handled the read; returns False -- deferring to the C path -- for
+  compressed or multi-strip planes, lsm files, or surprises in the IFDs.
+  """
+  if fn[-3:] in ('ext','lsm'): # lsm quirks live in the C path (cf. is_lsm)
+    return False
+  try:
+    f = open( fn, 'rb' )
+    try:
+      mm = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+    finally:
+      f.close()
+    try:
+      e, ifds = _tiff_ifds( mm )
+      depth, height, width = stack.shape
+      if len(ifds) != depth:
+        return False
+      dtype = stack.dtype.newbyteorder( e ) # assignment below swaps to native
+      for z, tags in enumerate( ifds ):
+        val = lambda label: _tag_values( mm, e, tags[label] )
+        if val( _TIFF_COMPRESSION )[0] != 1:
+          return False
+        if ( _TIFF_SAMPLES_PER_PIXEL in tags and
+             val( _TIFF_SAMPLES_PER_PIXEL )[0] != 1 ): # interleaved channels
+          return False                                 # (e.g. RGB): C path only
+        if val( _TIFF_BITS_PER_SAMPLE )[0] != 8*stack.dtype.itemsize:
+          return False
+        if ( val( _TIFF_IMAGE_WIDTH  )[0],
+             val( _TIFF_IMAGE_LENGTH )[0] ) != ( width, height ):
+          return False
+        offs = val( _TIFF_STRIP_OFFSETS )
+        cnts = val( _TIFF_STRIP_BYTE_COUNTS )
+        if len(offs) != 1 or cnts[0] < width*height*stack.dtype.itemsize:
+          return False
+        stack[z] = numpy.frombuffer( mm, dtype, width*height,
+                                     offs[0] ).reshape( height, width )
+      return True
+    finally:
+      mm.close()
+  except (IOError, OSError, KeyError, struct.error):
+    return False
 
 def readstack( filename ):
-  width, height, depth, kind = c_int(0),c_int(0),c_int(0),c_int(0)
-  if not os.path.exists(filename):
-    raise IOError, "File not found. (%s)"%filename 
-  if(not cReader.Get_Stack_Dimensions_px( filename,
-                                       byref(width),
-                                       byref(height),
-                                       byref(depth),
-                                       byref(kind) )):
-    raise IOError, "Couldn't read dimensions for %s"%filename
-  stack = zeros( (depth.value, height.value, width.value), dtype = _bpp[kind.value] )
-  cReader.Read_Tiff_Stack_Into_Buffer( filename, 
-                                        stack.ctypes.data_as( POINTER(c_uint8) ))
+  fn = _b( filename )
+  _prefetch( fn )
+  # no exists() probe: the C side distinguishes a missing file itself, so a
+  # stat per read (tens of ms on network mounts) buys nothing
+  width, height, depth, kind = _get_dims( fn )
+  # empty, not zeros: the C reader overwrites every byte, so a memset here
+  # would just be an extra pass over a potentially multi-GB buffer
+  stack = _empty_stack( (depth, height, width), _dtype_of(kind) )
+  if not _read_uncompressed( fn, stack ):
+    _read_into( fn, stack )
   return stack
   
+def _aligned_empty( shape, dtype, align = 64 ):
+  """ numpy.empty, but with the base address aligned to `align` bytes. """
+  dtype  = numpy.dtype( dtype )
+  nbytes = int( numpy.prod( shape ) ) * dtype.itemsize
+  buf = numpy.empty( nbytes + align, numpy.uint8 )
+  off = (-buf.ctypes.data) % align
+  return buf[off:off+nbytes].view( dtype ).reshape( shape )
+
+def readstack_planes( filename ):
+  """
+  Like readstack, but each plane lives in its own (h,w) array rather than one
+  contiguous depth*height*width block.  Easier on the allocator for very deep
+  stacks.  Returns a list of planes.
+  """
+  fn = _b( filename )
+  _prefetch( fn )
+  width, height, depth, kind = _get_dims( fn )
+  # cache-line aligned bases so downstream per-plane kernels can use
+  # aligned SIMD loads and rows never straddle a line at x=0
+  planes = [ _aligned_empty( (height, width), _dtype_of(kind) )
+             for z in xrange(depth) ]
+  if _c_read_planes is not None:
+    ptrs = ( c_void_p * depth )( *[ p.ctypes.data for p in planes ] )
+    if _c_read_planes( fn, ptrs, depth ) != depth:
+      raise IOError, "Couldn't read %s"%filename
+  else: # no planewise entry point: read contiguously and copy out
+    for p,s in zip( planes, readstack( filename ) ):
+      p[:] = s
+  return planes
+
+def readstack_shared( filename ):
+  """
+  Like readstack, but the pixels land in an anonymous *shared* mapping, so
+  processes forked afterwards (e.g. a multiprocessing.Pool) read the same
+  physical pages instead of re-decoding the TIFF or shipping the stack over
+  a pipe.  Returns a read-only view -- concurrent writers to shared pixels
+  are almost certainly a bug.  (No attach-by-name on this python; share by
+  forking after the read.)
+  """
+  fn = _b( filename )
+  _prefetch( fn )
+  width, height, depth, kind = _get_dims( fn )
+  mm = mmap.mmap( -1, depth*height*width*kind ) # MAP_SHARED|MAP_ANON
+  stack = numpy.frombuffer( mm, _dtype_of(kind) ).reshape( depth, height, width )
+  if not _read_uncompressed( fn, stack ):
+    _read_into( fn, stack )
+  view = stack.view()
+  view.flags.writeable = False
+  return view
+
+def readstack_raw( filename ):
+  """
+  Like readstack, but skips numpy entirely: returns
+  ( buffer, (depth,height,width), kind ) where buffer is a memoryview over a
+  ctypes byte array and kind is bytes per pixel.  Handy when the consumer
+  only needs the buffer protocol, e.g. blitting pixels to a viewer.
+  (memoryview.cast would carry the shape, but doesn't exist on this python.)
+  """
+  fn = _b( filename )
+  _prefetch( fn )
+  width, height, depth, kind = _get_dims( fn )
+  buf = ( c_uint8 * (depth*height*width*kind) )()
+  if _have_cffi:
+    _creader_ffi.Read_Tiff_Stack_Into_Buffer( fn,
+        _ffi.cast( "uint8_t*", addressof(buf) ) )
+  else:
+    _c_read_buf( fn, buf )
+  return memoryview( buf ), (depth, height, width), kind
+
+def readstacks( filenames, nprocs = None ):
+  """
+  Read several stacks concurrently, returning them in input order.
+
+  Uses one worker process per read.  Threads would be cheaper (ctypes drops
+  the GIL around the C call) but the reader library keeps global object
+  pools and static decode scratch, so only one thread per process may be
+  inside it at a time.
+  """
+  from multiprocessing import Pool
+  pool = Pool( nprocs )
+  try:
+    return pool.map( readstack, filenames )
+  finally:
+    pool.close()
+    pool.join()
+
+_stack_cache = OrderedDict() # (abspath, mtime, size) -> stack; newest last
+_STACK_CACHE_MAX = 4
+
+def clear_stack_cache():
+  """ Drop any cached stacks (call under memory pressure). """
+  _stack_cache.clear()
+
+def _cached_readstack( filename ):
+  """
+  readstack behind a small LRU keyed on (abspath, mtime, size): toggling
+  between views of the same file skips the re-decode and re-allocation
+  entirely, while an edited file misses on mtime/size and is reread.
+  Returns read-only views of the cached stack -- copy before mutating.
+  """
+  try:
+    st = os.stat( filename )
+  except OSError:
+    raise IOError, "File not found. (%s)"%filename
+  key = ( os.path.abspath( filename ), st.st_mtime, st.st_size )
+  try:
+    stack = _stack_cache.pop( key ) # re-inserted below as most recent
+  except KeyError:
+    stack = readstack( filename )
+  _stack_cache[key] = stack
+  while len(_stack_cache) > _STACK_CACHE_MAX:
+    _stack_cache.popitem( last = False )
+  view = stack.view()
+  view.flags.writeable = False
+  return view
+
 class TiffReader( StackReader ):
   def __init__(self, filename):
-    StackReader.__init__(self, readstack( filename ) )
+    StackReader.__init__(self, _cached_readstack( filename ) )
+
+class PlanewiseTiffReader( IMovieReader ):
+  """ A TiffReader whose planes are separate allocations (see readstack_planes). """
+  def __init__(self, filename):
+    IMovieReader.__init__(self)
+    self._planes = readstack_planes( filename )
+    self.size = self._planes[0].shape
+  def __getitem__(self, idx):
+    return self._planes[idx]
+  def __len__(self):
+    return len( self._planes )
+
+# TIFF 6.0 tag labels used by the lazy reader (cf. include/tiff_io.h)
+_TIFF_IMAGE_WIDTH       = 256
+_TIFF_IMAGE_LENGTH      = 257
+_TIFF_BITS_PER_SAMPLE   = 258
+_TIFF_COMPRESSION       = 259
+_TIFF_STRIP_OFFSETS     = 273
+_TIFF_SAMPLES_PER_PIXEL = 277
+_TIFF_STRIP_BYTE_COUNTS = 279
+
+_TIFF_TYPE_FMT = { 1:'B', 3:'H', 4:'I', 8:'h', 9:'i' } # integer-valued tag types
+
+def _tag_values( mm, e, entry ):
+  """ Decode one IFD tag entry to a tuple of ints. """
+  typ, cnt, raw, pos = entry
+  fmt  = _TIFF_TYPE_FMT[typ]
+  size = struct.calcsize(fmt)
+  if size*cnt <= 4:    # small values live in the entry itself,
+    off = pos
+  else:                # larger ones behind a file offset
+    off, = struct.unpack( e+'I', raw )
+  return struct.unpack( e+str(cnt)+fmt, mm[off:off+size*cnt] )
+
+def _tiff_ifds( mm ):
+  """ Walk the IFD chain of a classic TIFF.  Returns (endian, [tagdicts]). """
+  e = { 'II':'<', 'MM':'>' }.get( mm[:2] )
+  if e is None:
+    raise IOError, "Not a TIFF (bad byte-order mark)"
+  offset, = struct.unpack( e+'I', mm[4:8] )
+  ifds = []
+  while offset:
+    ntags, = struct.unpack( e+'H', mm[offset:offset+2] )
+    tags = {}
+    for i in xrange( ntags ):
+      pos = offset + 2 + 12*i
+      label, typ, cnt = struct.unpack( e+'HHI', mm[pos:pos+8] )
+      tags[label] = ( typ, cnt, mm[pos+8:pos+12], pos+8 )
+    ifds.append( tags )
+    pos = offset + 2 + 12*ntags
+    offset, = struct.unpack( e+'I', mm[pos:pos+4] )
+  return e, ifds
+
+class LazyTiffReader( IMovieReader ):
+  """
+  mmap-backed variant of TiffReader for large uncompressed stacks.
+
+  Nothing is decoded up front: init only walks the IFD chain, and
+  __getitem__ returns a read-only, zero-copy view into the file mapping,
+  so opening a multi-GB stack is cheap and only the planes actually
+  visited get faulted in.  Compressed stacks aren't supported -- use
+  TiffReader, which routes through the C decoder.
+  """
+  def __init__(self, filename):
+    IMovieReader.__init__(self)
+    f = open( filename, 'rb' )
+    try:
+      self._mm = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+    finally:
+      f.close()
+    e, ifds = _tiff_ifds( self._mm )
+    self._planes = []
+    for tags in ifds:
+      val = lambda label: _tag_values( self._mm, e, tags[label] )
+      if val( _TIFF_COMPRESSION )[0] != 1:
+        raise IOError, "%s is compressed; LazyTiffReader handles only uncompressed stacks"%filename
+      if ( _TIFF_SAMPLES_PER_PIXEL in tags and
+           val( _TIFF_SAMPLES_PER_PIXEL )[0] != 1 ):
+        raise IOError, "%s has interleaved channels; LazyTiffReader handles only single-sample planes"%filename
+      w     = val( _TIFF_IMAGE_WIDTH  )[0]
+      h     = val( _TIFF_IMAGE_LENGTH )[0]
+      bits  = val( _TIFF_BITS_PER_SAMPLE )[0]
+      dtype = _dtype_of( bits/8 ).newbyteorder( e )
+      self._planes.append( ( val( _TIFF_STRIP_OFFSETS ),
+                             val( _TIFF_STRIP_BYTE_COUNTS ),
+                             w, h, dtype ) )
+    h, w = self._planes[0][3], self._planes[0][2]
+    self.size = ( h, w )
+
+  def __getitem__(self, idx):
+    offs, cnts, w, h, dtype = self._planes[idx]
+    if len(offs) == 1:
+      im = numpy.frombuffer( self._mm, dtype, w*h, offs[0] )
+    else: # multi-strip: gather the strips (no decode, just copies)
+      raw = ''.join( self._mm[o:o+c] for o,c in zip(offs,cnts) )
+      im = numpy.frombuffer( raw, dtype, w*h )
+    return im.reshape( h, w )
+
+  def __len__(self):
+    return len( self._planes )
+
+  def __del__(self):
+    try:
+      self._mm.close()
+    except (AttributeError, ValueError): # never mapped, or views still alive
+      pass
 